@@ -23,6 +23,8 @@ NUM_OF_BONES = 20
 NUM_OF_FAT_MUSCLE = 3
 NUM_OF_PSOAS = 1
 NUM_OF_BRAIN = 83
+RESIZE_GRID_MULTIPLE = 8  # output grids of the GPU resize are rounded up to this many voxels per axis
+MAX_DECODE_WORKERS = 8  # workers decoding NIFTI files for the GPU reductions, one decoded volume each
 DUAL_ORGANS = [
     "Adrenal-glands",
     "Kidneys",
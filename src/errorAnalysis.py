@@ -23,6 +23,7 @@ import logging
 import constants as c
 import fileOp as fop
 import imageOp as iop
+import imageOpGPU
 import pandas as pd
 from halo import Halo
 
@@ -60,8 +61,7 @@ def split_multilabel_and_assign_names_func(multi_label_param, label) -> None:
             organ_file = value + '.nii.gz'
             output_file = os.path.join(output_dir, organ_file)
             logging.info(f"{organ_file} will be scaled with the label: {label}")
-            iop.retain_labels(multi_label_img, [label], output_file)
-            iop.binarize(output_file, output_file)
+            iop.binarize(iop.retain_labels(multi_label_img, [label], None), output_file)
         else:
             continue
     return None
@@ -99,32 +99,20 @@ def split_dual_organs_func(output_dir: str, single_organ_mask: str) -> None:
     fop.delete_files(str(pathlib.Path(single_organ_mask).parent), pathlib.Path(single_organ_mask).stem + '*')
 
 
-def assign_labels_after_split(split_dir: str) -> None:
+def get_split_label_intensity(mask_file: str) -> int:
     """
-    This function assigns labels to the split masks
-    :param split_dir: Path to the split masks
-    :return: None
-    """
-    logging.info(f'Assigning unique intensity labels to the split masks stored in {split_dir} based on predefined '
-                 f'constants: {c.ORGAN_INDEX_SPLIT}')
-    mask_files = fop.get_files(split_dir, '*.nii.gz')
-    with WorkerPool(n_jobs=cpu_count) as pool:
-        pool.map(assign_labels_after_split_func, mask_files, progress_bar=False)
-
-
-def assign_labels_after_split_func(mask_file: str) -> None:
+    This function returns the label intensity of a split mask
+    :param mask_file: Path to the split mask file
+    :return: Label intensity based on predefined constants (c.ORGAN_INDEX_SPLIT), 1 if the mask name is not listed
     """
-    This function assigns labels to the split masks
-    :param mask_file: Path to the mask file that needs to be assigned with a label
-    :return: None
-    """
-
     mask_name = pathlib.Path(mask_file).stem.split('.')[0]
+    label_intensity = 1
     for key, value in c.ORGAN_INDEX_SPLIT.items():
         if value in mask_name:
-            iop.scale_mask(mask_path=mask_file, out_path=mask_file, scale_factor=key)
+            label_intensity *= key
         else:
             continue
+    return label_intensity
 
 
 def similarity_space(multi_label_img: str, out_dir: str, csv_out: str) -> None:
@@ -139,10 +127,13 @@ def similarity_space(multi_label_img: str, out_dir: str, csv_out: str) -> None:
     logging.info(f"Performing error analysis in similarity space for {multi_label_img}")
     split_multilabel_and_assign_names(multi_label_img, sim_space_dir)
     split_dual_organs(sim_space_dir, sim_space_dir)
-    assign_labels_after_split(sim_space_dir)
+    logging.info(f'Assigning unique intensity labels to the split masks stored in {sim_space_dir} based on predefined '
+                 f'constants: {c.ORGAN_INDEX_SPLIT}')
     logging.info(f"Summing the split masks to get the final mask and store it in {sim_space_dir}")
     split_atlas = os.path.join(sim_space_dir, 'MOOSE-Split-unified-PET-CT-atlas.nii.gz')
-    iop.sum_image_stack(sim_space_dir, '*nii.gz', split_atlas)
+    mask_files = fop.get_files(sim_space_dir, '*nii.gz')
+    imageOpGPU.binarize_scale_sum(mask_files, [get_split_label_intensity(mask_file) for mask_file in mask_files],
+                                  split_atlas)
     logging.info(f"Measuring shape parameters for {split_atlas}")
     shape_parameters = iop.get_shape_parameters(split_atlas)
     normative_shape_parameters = pd.read_excel(c.NORMDB_DIR, engine="openpyxl")
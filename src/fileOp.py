@@ -16,8 +16,8 @@ import glob
 import json
 import os
 import pathlib
-import re
 import shutil
+import subprocess
 from pathlib import Path
 import natsort
 import pyfiglet
@@ -133,7 +133,7 @@ def compress_file(file: str) -> str:
     :param file: File to be compressed
     :return: None
     """
-    os.system("pigz " + re.escape(file))
+    subprocess.run(["pigz", file])
     return file + ".gz"
 
 
@@ -32,10 +32,8 @@ def rigid(fixed_img: str, moving_img: str, cost_function: str, multi_resolution_
     :return none
     """
     logging.info(" ")
-    cmd_to_run = f"greedy -d 3 -a -i " \
-                 f"{re.escape(fixed_img)} {re.escape(moving_img)} -ia-image-centers -dof 6 -o rigid.mat -n " \
-                 f"{multi_resolution_iterations} " \
-                 f"-m {cost_function}"
+    cmd_to_run = ["greedy", "-d", "3", "-a", "-i", fixed_img, moving_img, "-ia-image-centers", "-dof", "6", "-o",
+                  "rigid.mat", "-n", multi_resolution_iterations, "-m", cost_function]
     logging.info(f"Registration type: Rigid")
     logging.info(f"Reference image: {re.escape(fixed_img)}")
     logging.info(f"Moving image: {re.escape(moving_img)}")
@@ -44,7 +42,7 @@ def rigid(fixed_img: str, moving_img: str, cost_function: str, multi_resolution_
     logging.info(f"Multi-resolution level iterations: {multi_resolution_iterations}")
     logging.info(f"Transform file generated: rigid.mat")
     logging.info(" ")
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    subprocess.run(cmd_to_run, capture_output=True)
     print("Rigid registration complete")
 
 
@@ -57,10 +55,8 @@ def affine(fixed_img: str, moving_img: str, cost_function: str, multi_resolution
     :return none
     """
     logging.info(" ")
-    cmd_to_run = f"greedy -d 3 -a -i {re.escape(fixed_img)} {re.escape(moving_img)} -ia-image-centers -dof 12 -o " \
-                 f"affine.mat -n " \
-                 f"{multi_resolution_iterations} " \
-                 f"-m {cost_function} "
+    cmd_to_run = ["greedy", "-d", "3", "-a", "-i", fixed_img, moving_img, "-ia-image-centers", "-dof", "12", "-o",
+                  "affine.mat", "-n", multi_resolution_iterations, "-m", cost_function]
     logging.info(f"- Registration type: Affine")
     logging.info(f"- Reference image: {re.escape(fixed_img)}")
     logging.info(f"- Moving image: {re.escape(moving_img)}")
@@ -69,7 +65,7 @@ def affine(fixed_img: str, moving_img: str, cost_function: str, multi_resolution
     logging.info(f"- Multi-resolution level iterations: {multi_resolution_iterations}")
     logging.info(f"- Transform file generated: affine.mat")
     logging.info(" ")
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    subprocess.run(cmd_to_run, capture_output=True)
 
 
 
@@ -108,33 +104,18 @@ def resample(fixed_img: str, moving_img: str, resampled_moving_img: str, registr
     :return: None
     """
     if registration_type == 'rigid':
-        if segmentation and resampled_seg:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
-                         f"{re.escape(resampled_moving_img)} -ri LABEL " \
-                         f"0.2vox -rm {re.escape(segmentation)} {re.escape(resampled_seg)} -r rigid.mat"
-        else:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
-                         f"{re.escape(resampled_moving_img)} -r rigid.mat "
+        transforms = ["rigid.mat"]
     elif registration_type == 'affine':
-        if segmentation and resampled_seg:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
-                         f"{re.escape(resampled_moving_img)} -ri LABEL " \
-                         f"0.2vox -rm {re.escape(segmentation)} {re.escape(resampled_seg)} -r affine.mat"
-        else:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
-                         f"{re.escape(resampled_moving_img)} -r affine.mat"
+        transforms = ["affine.mat"]
     elif registration_type == 'deformable':
-        if segmentation and resampled_seg:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
-                         f"{re.escape(resampled_moving_img)} -ri LABEL " \
-                         f"0.2vox -rm {re.escape(segmentation)} {re.escape(resampled_seg)} -r warp.nii.gz affine.mat"
-        else:
-            cmd_to_run = f"greedy -d 3 -rf {re.escape(fixed_img)} -ri NN -rm {re.escape(moving_img)} " \
-                         f"{re.escape(resampled_moving_img)} -r warp.nii.gz " \
-                         f"affine.mat"
+        transforms = ["warp.nii.gz", "affine.mat"]
     else:
         sys.exit("Registration type not supported!")
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    cmd_to_run = ["greedy", "-d", "3", "-rf", fixed_img, "-ri", "NN", "-rm", moving_img, resampled_moving_img]
+    if segmentation and resampled_seg:
+        cmd_to_run += ["-ri", "LABEL", "0.2vox", "-rm", segmentation, resampled_seg]
+    cmd_to_run += ["-r"] + transforms
+    subprocess.run(cmd_to_run, capture_output=True)
     logging.info(f"Resampling parameters:")
     logging.info(f"- Reference image: {re.escape(fixed_img)}")
     logging.info(f"- Moving image: {re.escape(moving_img)}")
@@ -18,7 +18,6 @@
 import logging
 import os
 import pathlib
-import re
 import subprocess
 
 import nibabel as nib
@@ -79,11 +78,11 @@ def nondcm2nii(medimg_dir: str, file_extension: str, new_dir: str) -> None:
     for file in non_dcm_files:
         file_stem = pathlib.Path(file).stem
         nifti_file = os.path.join(new_dir, file_stem + ".nii.gz")
-        cmd_to_run = f"c3d {file} -o {nifti_file}"
+        cmd_to_run = ["c3d", file, "-o", nifti_file]
         logging.info(f"Converting {file} to {nifti_file}")
-        spinner = Halo(text=f"Running command: {cmd_to_run}", spinner='dots')
+        spinner = Halo(text=f"Running command: {' '.join(cmd_to_run)}", spinner='dots')
         spinner.start()
-        subprocess.run(cmd_to_run, shell=True, capture_output=True)
+        subprocess.run(cmd_to_run, capture_output=True)
         spinner.succeed()
         logging.info("Done")
 
@@ -92,11 +91,11 @@ def dcm2nii(dicom_dir: str) -> None:
     """Convert DICOM images to NIFTI using dcm2niix
     :param dicom_dir: Directory containing the DICOM images
     """
-    cmd_to_run = f"dcm2niix -f %b {re.escape(dicom_dir)}"
+    cmd_to_run = ["dcm2niix", "-f", "%b", dicom_dir]
     logging.info(f"Converting DICOM images in {dicom_dir} to NIFTI")
     spinner = Halo(text=f"Converting DICOM images in {dicom_dir} to NIFTI", spinner='dots')
     spinner.start()
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    subprocess.run(cmd_to_run, capture_output=True)
     spinner.succeed(text=f"Converted DICOM images in {dicom_dir} to NIFTI")
     logging.info("Done")
 
@@ -11,79 +11,192 @@
 # Description: This module contains functions to perform basic image processing operations
 # License: Apache 2.0
 # **********************************************************************************************************************
+import functools
+import multiprocessing
 import os
 import pathlib
-import re
+import queue
 import subprocess
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from typing import Union
 
 import SimpleITK
+import nibabel as nib
 import numpy as np
 import pandas as pd
 import pydicom
 
 import constants as c
+import imageOpGPU
 
 import cupy as cp
-from cucim.skimage.transform import resize
+import cupyx.scipy.ndimage
+from cucim.skimage.util import img_as_float
 
 from time import perf_counter
 
 
-def get_dimensions(nifti_file: str) -> int:
+@functools.lru_cache(maxsize=8)
+def _read_image(nifti_file: str, mtime_ns: int, pixel_type: int) -> SimpleITK.Image:
     """
-    Get the dimensions of a NIFTI image file
-    :param nifti_file: NIFTI file to check
+    Read an image from disk; memoized on the file path, its modification time and the requested pixel type
+    :param nifti_file: Path to the image to read
+    :param mtime_ns: Modification time of the file in nanoseconds, invalidates the cache when the file is rewritten
+    :param pixel_type: SimpleITK pixel type to read the image as
+    :return: SimpleITK image
+    """
+    return SimpleITK.ReadImage(nifti_file, pixel_type)
+
+
+def _read_image_cached(nifti_file: str, pixel_type: int = SimpleITK.sitkUnknown) -> SimpleITK.Image:
+    """
+    Read an image through the in-memory cache, so that repeated queries on the same file are decoded only once.
+    The returned image is shared between callers and must not be modified in place.
+    :param nifti_file: Path to the image to read
+    :param pixel_type: SimpleITK pixel type to read the image as (default: pixel type on disk)
+    :return: SimpleITK image
+    """
+    return _read_image(str(nifti_file), os.stat(nifti_file).st_mtime_ns, pixel_type)
+
+
+def _as_image(image: Union[str, SimpleITK.Image], pixel_type: int = SimpleITK.sitkUnknown) -> SimpleITK.Image:
+    """
+    Return a SimpleITK image for either a path or an already loaded image
+    :param image: Path to the image or SimpleITK image
+    :param pixel_type: SimpleITK pixel type to return the image as (default: unchanged)
+    :return: SimpleITK image
+    """
+    if isinstance(image, SimpleITK.Image):
+        if pixel_type == SimpleITK.sitkUnknown or image.GetPixelID() == pixel_type:
+            return image
+        return SimpleITK.Cast(image, pixel_type)
+    return _read_image_cached(image, pixel_type)
+
+
+def _as_label_image(image: Union[str, SimpleITK.Image]) -> SimpleITK.Image:
+    """
+    Return a label image with an integer pixel type; floating point label maps (e.g. written by c3d or greedy) are
+    cast to Int32, since the labels are integer valued anyway
+    :param image: Path to the label image or SimpleITK image
+    :return: SimpleITK image with an integer pixel type
     """
-    nifti_img = SimpleITK.ReadImage(nifti_file)
-    img_dim = nifti_img.GetDimension()
+    label_img = _as_image(image)
+    if label_img.GetPixelID() in (SimpleITK.sitkFloat32, SimpleITK.sitkFloat64):
+        return SimpleITK.Cast(label_img, SimpleITK.sitkInt32)
+    return label_img
+
+
+def _read_array(image: Union[str, SimpleITK.Image]) -> np.ndarray:
+    """
+    Return the voxel array of an image in SimpleITK (z, y, x) axis order without going through SimpleITK for files.
+    Files are read with nibabel, which uses indexed_gzip (if installed) for faster decompression of .nii.gz files.
+    :param image: Path to the image or SimpleITK image
+    :return: Read-only view of the voxel array
+    """
+    if isinstance(image, SimpleITK.Image):
+        return SimpleITK.GetArrayViewFromImage(image)
+    # nibabel arrays are in (x, y, z) order, so the transpose is a (contiguous) view in (z, y, x) order
+    return np.asanyarray(nib.load(image, mmap=True, keep_file_open=True).dataobj).T
+
+
+def _write_image(image: SimpleITK.Image, out_image: str = None) -> SimpleITK.Image:
+    """
+    Write an image to disk
+    :param image: SimpleITK image to write
+    :param out_image: Path to the output image, None to skip the write for intermediate steps of a chain
+    :return: The SimpleITK image, so that chained operations can continue in memory
+    """
+    if out_image is None:
+        return image
+    SimpleITK.WriteImage(image, out_image)
+    # Entries of a rewritten file can never be hit again, drop them instead of keeping the decoded volumes alive
+    _read_image.cache_clear()
+    return image
+
+
+def get_dimensions(nifti_file: Union[str, SimpleITK.Image]) -> int:
+    """
+    Get the dimensions of a NIFTI image file
+    :param nifti_file: NIFTI file (or loaded SimpleITK image) to check
+    """
+    if isinstance(nifti_file, SimpleITK.Image):
+        return nifti_file.GetDimension()
+    # Only the header is needed
+    reader = SimpleITK.ImageFileReader()
+    reader.SetFileName(nifti_file)
+    reader.ReadImageInformation()
+    img_dim = reader.GetDimension()
     return img_dim
 
 
-def get_pixel_id_type(nifti_file: str) -> str:
+def get_pixel_id_type(nifti_file: Union[str, SimpleITK.Image]) -> str:
     """
     Get the pixel id type of a NIFTI image file
-    :param nifti_file: NIFTI file to check
-    """
-    nifti_img = SimpleITK.ReadImage(nifti_file)
-    pixel_id_type = nifti_img.GetPixelIDTypeAsString()
+    :param nifti_file: NIFTI file (or loaded SimpleITK image) to check
+    """
+    if isinstance(nifti_file, SimpleITK.Image):
+        return nifti_file.GetPixelIDTypeAsString()
+    # Only the header is needed
+    reader = SimpleITK.ImageFileReader()
+    reader.SetFileName(nifti_file)
+    reader.ReadImageInformation()
+    pixel_id_type = SimpleITK.GetPixelIDValueAsString(reader.GetPixelID())
     return pixel_id_type
 
 
-def get_intensity_statistics(nifti_file: str, multi_label_file: str, out_csv: str) -> None:
+def get_intensity_statistics(nifti_file: Union[str, SimpleITK.Image], multi_label_file: Union[str, SimpleITK.Image],
+                             out_csv: str) -> None:
     """
     Get the intensity statistics of a NIFTI image file
-    :param nifti_file: NIFTI file to check
-    :param multi_label_file: Multilabel file that is used to calculate the intensity statistics from nifti_file
+    :param nifti_file: NIFTI file (or loaded SimpleITK image) to check
+    :param multi_label_file: Multilabel file (or loaded SimpleITK image) that is used to calculate the intensity
+    statistics from nifti_file. The Int32 cast of the labels is cached and reused by get_shape_parameters.
     :param out_csv: Path to the output csv file
     :return None
      """
-    nifti_img = SimpleITK.ReadImage(nifti_file)
-    multi_label_img = SimpleITK.ReadImage(multi_label_file, SimpleITK.sitkInt32)
-    intensity_statistics = SimpleITK.LabelIntensityStatisticsImageFilter()
-    intensity_statistics.Execute(multi_label_img, nifti_img)
-    stats_list = [(intensity_statistics.GetMean(i), intensity_statistics.GetStandardDeviation(i),
-                   intensity_statistics.GetMedian(i), intensity_statistics.GetMaximum(i),
-                   intensity_statistics.GetMinimum(i)) for i in intensity_statistics.GetLabels()]
+    multi_label_img = _as_image(multi_label_file, SimpleITK.sitkInt32)
+    label_array = SimpleITK.GetArrayViewFromImage(multi_label_img).ravel()
+    # Read-only views in the native pixel type, no copy of the volumes is made here
+    img_array = _read_array(nifti_file).ravel()
+
+    # Mean and standard deviation of all labels in a single pass of weighted histograms
+    counts = np.bincount(label_array)
+    sums = np.bincount(label_array, weights=img_array)
+    sums_of_squares = np.bincount(label_array, weights=np.square(img_array, dtype=np.float64))
+    labels = np.flatnonzero(counts[1:]) + 1  # background (0) is excluded, as in LabelIntensityStatisticsImageFilter
+    num_voxels = counts[labels]
+    mean = sums[labels] / num_voxels
+    variance = (sums_of_squares[labels] - num_voxels * mean ** 2) / np.maximum(num_voxels - 1, 1)
+    standard_deviation = np.sqrt(np.clip(variance, 0, None))
+
+    # Order statistics of all labels in one batched call on the GPU
+    label_array_gpu = cp.asarray(label_array)
+    img_array_gpu = cp.asarray(img_array)
+    index = cp.asarray(labels)
+    median = cp.asnumpy(cupyx.scipy.ndimage.median(img_array_gpu, label_array_gpu, index))
+    maximum = cp.asnumpy(cupyx.scipy.ndimage.maximum(img_array_gpu, label_array_gpu, index))
+    minimum = cp.asnumpy(cupyx.scipy.ndimage.minimum(img_array_gpu, label_array_gpu, index))
+
     columns = ['Mean', 'Standard-Deviation', 'Median', 'Maximum', 'Minimum']
-    stats_df = pd.DataFrame(data=stats_list, index=intensity_statistics.GetLabels(), columns=columns)
-    labels_present = stats_df.index.to_list()
-    regions_present = []
-    for label in labels_present:
-        if label in c.ORGAN_INDEX:
-            regions_present.append(c.ORGAN_INDEX[label])
-        else:
-            continue
-    stats_df.insert(0, 'Regions-Present', np.array(regions_present))
+    stats_df = pd.DataFrame(data=np.column_stack((mean, standard_deviation, median, maximum, minimum)),
+                            index=labels.tolist(), columns=columns)
+    # Keep only the labels with a known region name, so that the names line up with their rows
+    regions_present = np.array([c.ORGAN_INDEX.get(label) for label in stats_df.index.to_list()], dtype=object)
+    known_regions = regions_present != None  # noqa: E711, element-wise comparison
+    stats_df = stats_df.iloc[known_regions]
+    stats_df.insert(0, 'Regions-Present', regions_present[known_regions])
     stats_df.to_csv(out_csv)
 
 
-def get_shape_parameters(label_image: str) -> pd.DataFrame:
+def get_shape_parameters(label_image: Union[str, SimpleITK.Image]) -> pd.DataFrame:
     """
     Get shape parameters of a label image
-    :param label_image: Label image to get the shape parameters from
+    :param label_image: Label image (path or loaded SimpleITK image) to get the shape parameters from
     :return: shape_parameters_df, a dataframe with the shape parameters (Physical size, Centroid, Elongation, Flatness)
     """
-    label_img = SimpleITK.Cast(SimpleITK.ReadImage(label_image), SimpleITK.sitkInt32)
+    label_img = _as_image(label_image, SimpleITK.sitkInt32)
     label_shape_parameters = SimpleITK.LabelShapeStatisticsImageFilter()
     label_shape_parameters.Execute(label_img)
     shape_parameters_list = [(label_shape_parameters.GetPhysicalSize(i), label_shape_parameters.GetCentroid(i),
@@ -101,7 +214,9 @@ def get_suv_parameters(dicom_file: str) -> dict:
     :param dicom_file: Path to the Dicom file to get the SUV parameters from
     :return: suv_parameters, a dictionary with the SUV parameters (weight in kg, dose in mBq)
     """
-    ds = pydicom.dcmread(dicom_file)
+    # Only parse the two tags needed, and never the pixel data
+    ds = pydicom.dcmread(dicom_file, stop_before_pixels=True,
+                         specific_tags=['PatientWeight', 'RadiopharmaceuticalInformationSequence'])
     suv_parameters = {'weight[kg]': ds.PatientWeight, 'total_dose[mBq]': (
             float(ds.RadiopharmaceuticalInformationSequence[0].RadionuclideTotalDose)
             / 1000000
@@ -118,8 +233,8 @@ def convert_bq_to_suv(bq_image: str, out_suv_image: str, suv_parameters: dict) -
     """
     suv_denominator = (suv_parameters["total_dose[mBq]"] / suv_parameters["weight[kg]"]) * 1000  # Units in kBq/mL
     suv_convertor = 1 / suv_denominator
-    cmd_to_run = f"c3d {re.escape(bq_image)} -scale {suv_convertor} -o {re.escape(out_suv_image)}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    cmd_to_run = ["c3d", bq_image, "-scale", str(suv_convertor), "-o", out_suv_image]
+    subprocess.run(cmd_to_run, capture_output=True)
     return out_suv_image
 
 
@@ -132,55 +247,64 @@ def reslice_identity(reference_image: str, image_to_reslice: str, out_resliced_i
     :param interpolation: Interpolation method to use (nearest, linear, cubic)
 
     """
-    cmd_to_run = f"c3d {reference_image} {image_to_reslice} -interpolation {interpolation} -reslice-identity -o" \
-                 f" {out_resliced_image}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    cmd_to_run = ["c3d", reference_image, image_to_reslice, "-interpolation", interpolation, "-reslice-identity",
+                  "-o", out_resliced_image]
+    subprocess.run(cmd_to_run, capture_output=True)
 
 
-def retain_labels(image_to_retain_labels: str, labels_to_retain: list, out_image: str) -> None:
+def retain_labels(image_to_retain_labels: Union[str, SimpleITK.Image], labels_to_retain: list,
+                  out_image: str = None) -> SimpleITK.Image:
     """
     Retain only the labels in the list
-    :param image_to_retain_labels: Path to the image to retain labels from
+    :param image_to_retain_labels: Path to the image (or loaded SimpleITK image) to retain labels from
     :param labels_to_retain: List of labels to retain
-    :param out_image: Path to the retained image
+    :param out_image: Path to the retained image (None: keep it in memory only)
+    :return: The resulting image, to pass on to the next operation instead of reading out_image again
     """
-    labels = " ".join(str(i) for i in labels_to_retain)
-    cmd_to_run = f"c3d {re.escape(image_to_retain_labels)} -retain-labels {labels} -o {re.escape(out_image)}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    label_img = _as_label_image(image_to_retain_labels)
+    retain_mask = label_img == labels_to_retain[0]
+    for label in labels_to_retain[1:]:
+        retain_mask = retain_mask | (label_img == label)
+    return _write_image(SimpleITK.Mask(label_img, retain_mask), out_image)
 
 
-def shift_intensity(image_to_shift: str, shift_amount: int, out_image: str) -> None:
+def shift_intensity(image_to_shift: Union[str, SimpleITK.Image], shift_amount: int,
+                    out_image: str = None) -> SimpleITK.Image:
     """
-    Shift the intensity of an image
-    :param image_to_shift: Path to the image to shift
+    Shift the intensity of an image. Computed and written in float32, as c3d does, so that shifted labels cannot
+    saturate the (usually UInt8) pixel type of the input
+    :param image_to_shift: Path to the image (or loaded SimpleITK image) to shift
     :param shift_amount: Amount to shift the image by
-    :param out_image: Path to the shifted image
+    :param out_image: Path to the shifted image (None: keep it in memory only)
+    :return: The resulting image, to pass on to the next operation instead of reading out_image again
     """
-    cmd_to_run = f"c3d {re.escape(image_to_shift)} -shift {str(shift_amount)} -o {re.escape(out_image)}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    return _write_image(SimpleITK.ShiftScale(_as_image(image_to_shift, SimpleITK.sitkFloat32), shift_amount, 1.0),
+                        out_image)
 
 
-def replace_intensity(image_to_replace: str, intensity: list, out_image: str) -> None:
+def replace_intensity(image_to_replace: Union[str, SimpleITK.Image], intensity: list,
+                      out_image: str = None) -> SimpleITK.Image:
     """
-    Replace the intensity of an image
-    :param image_to_replace: Path to the image to replace
+    Replace the intensity of a label image
+    :param image_to_replace: Path to the image (or loaded SimpleITK image) to replace
     :param intensity:
-    Replace intensity I1 by J1, I2 by J2 and so on. Allowed values of intensity include nan, inf and -inf.
-    :param out_image: Path to the replaced image
+    Replace intensity I1 by J1, I2 by J2 and so on. All replacements are applied simultaneously.
+    :param out_image: Path to the replaced image (None: keep it in memory only)
+    :return: The resulting image, to pass on to the next operation instead of reading out_image again
     """
-    replace_intensity_str = " ".join(str(i) for i in intensity)
-    cmd_to_run = f"c3d {re.escape(image_to_replace)} -replace {replace_intensity_str} -o {re.escape(out_image)}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    change_map = {float(old): float(new) for old, new in zip(intensity[::2], intensity[1::2])}
+    return _write_image(SimpleITK.ChangeLabel(_as_label_image(image_to_replace), changeMap=change_map), out_image)
 
 
-def binarize(label_img: str, out_img: str) -> None:
+def binarize(label_img: Union[str, SimpleITK.Image], out_img: str = None) -> SimpleITK.Image:
     """
-    Binarize an image
-    :param label_img: Path to the image to binarize
-    :param out_img: Path to the binarized image
+    Binarize an image, i.e. set all non-zero voxels to 1
+    :param label_img: Path to the image (or loaded SimpleITK image) to binarize
+    :param out_img: Path to the binarized image (None: keep it in memory only)
+    :return: The resulting image, to pass on to the next operation instead of reading out_img again
     """
-    cmd_to_run = f"c3d {re.escape(label_img)} -binarize -o {re.escape(out_img)}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    img = _as_image(label_img)
+    return _write_image(SimpleITK.Cast(img != 0, img.GetPixelID()), out_img)
 
 
 def remove_overlays(reference_image: str, image_to_remove_overlays: str, out_image: str) -> None:
@@ -190,58 +314,58 @@ def remove_overlays(reference_image: str, image_to_remove_overlays: str, out_ima
     :param image_to_remove_overlays: Path to the image to remove overlays from
     :param out_image: Path to the image with overlays removed
     """
-    cmd_to_run = f"c3d {re.escape(reference_image)} -binarize -popas BIN -push BIN -replace 1 0 0 1 -popas INVBIN " \
-                 f"-push INVBIN {re.escape(image_to_remove_overlays)} -multiply -o {re.escape(out_image)}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    cmd_to_run = ["c3d", reference_image, "-binarize", "-popas", "BIN", "-push", "BIN", "-replace", "1", "0", "0", "1",
+                  "-popas", "INVBIN", "-push", "INVBIN", image_to_remove_overlays, "-multiply", "-o", out_image]
+    subprocess.run(cmd_to_run, capture_output=True)
 
 
-def sum_image_stack(img_dir: str, wild_card: str, out_img: str) -> None:
+def sum_image_stack(img_dir: str, wild_card: str, out_img: str) -> str:
     """
     Sum a list of images
     :param img_dir: Directory containing the list of images to sum
     :param wild_card: Wildcard to use to find the images to sum
     :param out_img: Path to the summed image
+    :return: Path to the summed image
     """
-    os.chdir(img_dir)
-    cmd_to_run = f"c3d {wild_card} -accum -add -endaccum -o {re.escape(out_img)}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    return imageOpGPU.sum_image_stack(img_dir, wild_card, out_img)
 
 
-def add_image(image_to_add: str, image_to_add_to: str, out_image: str) -> None:
+def add_image(image_to_add: Union[str, SimpleITK.Image], image_to_add_to: Union[str, SimpleITK.Image],
+              out_image: str = None) -> SimpleITK.Image:
     """
-    Add two images together
-    :param image_to_add: Path to the image to add
-    :param image_to_add_to: Path to the image to add to
-    :param out_image: Path to the added image
+    Add two images together. Computed and written in float32, as c3d does, so that the sum cannot overflow the pixel
+    type of the inputs
+    :param image_to_add: Path to the image (or loaded SimpleITK image) to add
+    :param image_to_add_to: Path to the image (or loaded SimpleITK image) to add to
+    :param out_image: Path to the added image (None: keep it in memory only)
+    :return: The resulting image, to pass on to the next operation instead of reading out_image again
     """
-    cmd_to_run = f"c3d {re.escape(image_to_add)} {re.escape(image_to_add_to)} -add -o {re.escape(out_image)}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    img = _as_image(image_to_add, SimpleITK.sitkFloat32)
+    img_to_add_to = _as_image(image_to_add_to, SimpleITK.sitkFloat32)
+    return _write_image(SimpleITK.Add(img, img_to_add_to), out_image)
 
 
-def crop_image_using_mask(image_to_crop: str, multilabel_mask: str, out_image: str, label_intensity=int) -> str:
+def crop_image_using_mask(image_to_crop: Union[str, SimpleITK.Image], multilabel_mask: Union[str, SimpleITK.Image],
+                          out_image: str, label_intensity=int) -> str:
     """
     Crop an image using a mask
-    :param image_to_crop: Path to the image to crop
-    :param multilabel_mask: Path to the multilabel mask
+    :param image_to_crop: Path to the image (or loaded SimpleITK image) to crop
+    :param multilabel_mask: Path to the multilabel mask (or loaded SimpleITK image)
     :param out_image: Path to the cropped image
     :param label_intensity: Label intensity to crop
     """
-    img = SimpleITK.ReadImage(image_to_crop)
-    mask = SimpleITK.ReadImage(multilabel_mask)
-    label_shape_filter = SimpleITK.LabelShapeStatisticsImageFilter()
-    label_shape_filter.Execute(mask == label_intensity)
-    bbox = np.asarray(label_shape_filter.GetBoundingBox(1))
+    img = _as_image(image_to_crop)
+    mask = _as_image(multilabel_mask)
+    label_mask = SimpleITK.GetArrayViewFromImage(mask) == label_intensity  # (z, y, x)
+    # Bounding box of the label from the projections of the mask onto each axis, in (x, y, z) order
+    extents = [np.flatnonzero(label_mask.any(axis=other_axes)) for other_axes in ((0, 1), (0, 2), (1, 2))]
     img_dim = np.asarray(img.GetSize())
-    start_index = bbox[0:3]
-    size = bbox[3:]
-    new_index = start_index - c.CROPPED_PADDING
-    new_size = size + c.CROPPED_PADDING
-    lower_bounds = new_index <= 0
-    new_index[lower_bounds] = start_index[lower_bounds]
-    upper_bounds = new_index + new_size
-    out_of_bounds = upper_bounds >= img_dim
-    padding_value = img_dim[out_of_bounds] - (new_index[out_of_bounds] + size[out_of_bounds])
-    new_size[out_of_bounds] = size[out_of_bounds] + padding_value
+    start_index = np.array([extent[0] for extent in extents])
+    size = np.array([extent[-1] - extent[0] + 1 for extent in extents])
+    # Pad the bounding box on both sides and clamp it to the image extent
+    new_index = np.clip(start_index - c.CROPPED_PADDING, 0, img_dim - 1)
+    end_index = np.clip(start_index + size + c.CROPPED_PADDING, 0, img_dim)
+    new_size = end_index - new_index
     cropped_img = SimpleITK.RegionOfInterest(img, new_size.astype("int").tolist(), (new_index.astype("int").tolist()))
     SimpleITK.WriteImage(cropped_img, out_image)
     return out_image
@@ -249,28 +373,33 @@ def crop_image_using_mask(image_to_crop: str, multilabel_mask: str, out_image: s
 
 def split_mask_to_left_right(binary_mask_path: str, out_dir: str) -> None:
     """
-    Split a binary mask into left and right masks
+    Split a binary mask into left and right masks at the mid-plane of the image along x
     :param binary_mask_path: Path to the binary mask
     :param out_dir: Path to the output directory
     """
     binary_mask = pathlib.Path(binary_mask_path).stem.split(".")[0]
     right_mask = 'R-' + binary_mask + '.nii.gz'
     left_mask = 'L-' + binary_mask + '.nii.gz'
-    cmd_to_run = f"c3d {re.escape(binary_mask_path)} -as SEG -cmv -pop -pop  -thresh 50% inf 1 0 -as MASK -push SEG " \
-                 f"-times -o {re.escape(os.path.join(out_dir, left_mask))} -push MASK -replace 1 0 0 1 -push SEG " \
-                 f"-times -o {re.escape(os.path.join(out_dir, right_mask))}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    mask_img = _as_image(binary_mask_path)
+    mask = SimpleITK.GetArrayViewFromImage(mask_img)  # (z, y, x)
+    # Voxels at or beyond the central x coordinate are left, the others right
+    is_left = np.arange(mask.shape[2]) >= (mask.shape[2] - 1) / 2
+    for side_mask, side in ((left_mask, is_left), (right_mask, ~is_left)):
+        side_img = SimpleITK.GetImageFromArray(mask * side.astype(mask.dtype))
+        side_img.CopyInformation(mask_img)
+        _write_image(side_img, os.path.join(out_dir, side_mask))
 
 
-def scale_mask(mask_path: str, out_path: str, scale_factor: int) -> None:
+def scale_mask(mask_path: Union[str, SimpleITK.Image], out_path: str, scale_factor: int) -> SimpleITK.Image:
     """
-    Scale a mask with a particular scaling factor
-    :param mask_path: Path to the mask to scale
+    Scale a mask with a particular scaling factor. Computed and written in float32, as c3d does, so that the product
+    cannot wrap around in the (usually UInt8) pixel type of the input
+    :param mask_path: Path to the mask (or loaded SimpleITK image) to scale
     :param out_path: Path to the scaled mask
     :param scale_factor: Scale factor
+    :return: The written image, to pass on to the next operation instead of reading out_path again
     """
-    cmd_to_run = f"c3d {re.escape(mask_path)} -scale {scale_factor} -o {re.escape(out_path)}"
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    return _write_image(SimpleITK.Multiply(_as_image(mask_path, SimpleITK.sitkFloat32), float(scale_factor)), out_path)
 
 
 def extract_central_slice_as_png(image_path: str, out_path: str) -> str:
@@ -280,9 +409,9 @@ def extract_central_slice_as_png(image_path: str, out_path: str) -> str:
     :param out_path: Path to the output png
     :return: Path to the output png
     """
-    cmd_to_run = f"c3d {re.escape(image_path)} -slice y 50% -flip y -type uchar -stretch 0.001% 99.999% 5 255 -o " \
-                 f"{re.escape(out_path)} "
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    cmd_to_run = ["c3d", image_path, "-slice", "y", "50%", "-flip", "y", "-type", "uchar", "-stretch", "0.001%",
+                  "99.999%", "5", "255", "-o", out_path]
+    subprocess.run(cmd_to_run, capture_output=True)
     return out_path
 
 
@@ -320,6 +449,89 @@ def get_resize_factor(img: np.ndarray, spacing: list, target_spacing: list) -> n
     return resize_factor
 
 
+@functools.lru_cache(maxsize=1)
+def _get_transfer_stream() -> cp.cuda.Stream:
+    """
+    Get the module-level CUDA stream used for host/device transfers. Created on first use, so that importing this
+    module does not initialise a CUDA context before worker processes are forked.
+    :return: Non-blocking CUDA stream
+    """
+    return cp.cuda.Stream(non_blocking=True)
+
+
+def _pinned_empty(shape: tuple, dtype: np.dtype) -> np.ndarray:
+    """
+    Allocate an uninitialised numpy array in pinned (page-locked) host memory, which lets host/device copies run
+    asynchronously at full PCIe bandwidth
+    :param shape: Shape of the array
+    :param dtype: Data type of the array
+    :return: Numpy array backed by pinned memory
+    """
+    count = int(np.prod(shape))
+    pinned_memory = cp.cuda.alloc_pinned_memory(count * np.dtype(dtype).itemsize)
+    return np.frombuffer(pinned_memory, dtype=dtype, count=count).reshape(shape)
+
+
+def _to_device(img: np.ndarray, stream: cp.cuda.Stream) -> cp.ndarray:
+    """
+    Copy a numpy array to the GPU through a pinned staging buffer on the given stream. Returns once the copy has
+    completed: ndarray.set does not keep the source alive, and the pinned block goes back to the pool when the
+    staging buffer is dropped, where another thread could refill it while the copy is still reading from it.
+    :param img: Numpy array to copy
+    :param stream: CUDA stream to enqueue the copy on
+    :return: Cupy array
+    """
+    host = _pinned_empty(img.shape, img.dtype)
+    host[...] = img
+    device = cp.empty(img.shape, dtype=img.dtype)
+    device.set(host, stream=stream)
+    # Hold the staging buffer until the copy is done
+    stream.record().synchronize()
+    return device
+
+
+def _to_host(device: cp.ndarray, stream: cp.cuda.Stream) -> np.ndarray:
+    """
+    Copy a cupy array back to pinned host memory on the given stream and wait for the copy to finish
+    :param device: Cupy array to copy
+    :param stream: CUDA stream to enqueue the copy on
+    :return: Numpy array backed by pinned memory
+    """
+    host = _pinned_empty(device.shape, device.dtype)
+    device.get(stream=stream, out=host)
+    stream.synchronize()
+    return host
+
+
+@functools.lru_cache(maxsize=32)
+def _get_resize_function(input_shape: tuple, output_shape: tuple, order: int):
+    """
+    Get a spline resize function for a fixed input and output shape. Equivalent to
+    cucim.skimage.transform.resize(img, output_shape, order, mode="edge", anti_aliasing=False), but the spline is
+    evaluated on an output grid rounded up to a multiple of 8 voxels per axis and cropped afterwards. The generated
+    CUDA kernels are specialised on the output grid shape, so volumes of similar size share one compiled kernel instead
+    of triggering a new compile per shape.
+    :param input_shape: Shape of the input volume
+    :param output_shape: Shape of the resized volume
+    :param order: Order of spline interpolation
+    :return: Function mapping a cupy volume of input_shape to a resized cupy volume of output_shape
+    """
+    scale = np.asarray(input_shape) / np.asarray(output_shape)
+    # Voxel centers are aligned as in resize (ndimage zoom with grid_mode=True)
+    offset = (0.5 * scale - 0.5).tolist()
+    grid_shape = tuple(int(-(-size // c.RESIZE_GRID_MULTIPLE) * c.RESIZE_GRID_MULTIPLE) for size in output_shape)
+    crop = tuple(slice(0, size) for size in output_shape)
+
+    def resize_volume(img: cp.ndarray) -> cp.ndarray:
+        img = img_as_float(img)
+        resized_img = cupyx.scipy.ndimage.affine_transform(img, cp.asarray(scale), offset=offset,
+                                                           output_shape=grid_shape, order=order, mode="nearest")
+        # Clip to the input range, as resize does for spline orders > 0
+        return cp.clip(resized_img[crop], img.min(), img.max())
+
+    return resize_volume
+
+
 def resample_image(nifti_file: str, target_spacing: list, order: int) -> SimpleITK.Image:
     """Resample image to the target spacing
 
@@ -337,39 +549,88 @@ def resample_image(nifti_file: str, target_spacing: list, order: int) -> SimpleI
 
     # Read sitk image
     sitk_img = SimpleITK.ReadImage(nifti_file)
-    # Get npy array
-    img = SimpleITK.GetArrayFromImage(sitk_img)
-    # Transpose: (z, x, y) -> (x, y, z)
-    img = np.transpose(img)
+    print(nifti_file)
+    # Resample on the module-level transfer stream
+    sitk_out = _resample_sitk_image(sitk_img, target_spacing, order, _get_transfer_stream())
+
+    # End counter
+    end_time = perf_counter()
+    # Report resampling time
+    delta_time = end_time - start_time
+    print(f"Resampling took {delta_time:.2f} seconds")
+
+    return sitk_out
+
+
+def _resample_sitk_image(sitk_img: SimpleITK.Image, target_spacing: list, order: int,
+                         stream: cp.cuda.Stream) -> SimpleITK.Image:
+    """Resample an already loaded image to the target spacing on the given CUDA stream
+
+    :param sitk_img: SimpleITK image to resample
+    :type sitk_img: SimpleITK.Image
+    :param target_spacing: Target spacing (can be either int or float)
+    :type target_spacing: list
+    :param order: Order of spline interpolation (0: Nearest-neighbor, 1: Linear, 3: Bi-cubic). Orders 0 and 1 are
+    resampled with SimpleITK, higher orders with cucim on the GPU.
+    :type order: int
+    :param stream: CUDA stream to run the transfers and the resize on (only used for order >= 2)
+    :type stream: cp.cuda.Stream
+    :return: SimpleITK image.
+    :rtype: SimpleITK.Image
+    """
     # Get spacing of input image
     spacing = sitk_img.GetSpacing()
-    # Get resize factor
-    resize_factor = get_resize_factor(img, spacing, target_spacing)
+
+    # Nearest-neighbor and linear interpolation: a single ITK resampling pass on the CPU is cheaper than the
+    # round trip to the GPU
+    if order in (0, 1):
+        new_size = [int(round(size * old / new)) for size, old, new in zip(sitk_img.GetSize(), spacing,
+                                                                            target_spacing)]
+        print(f"spacing: {spacing}")
+        print(f"size: {sitk_img.GetSize()}")
+        print(f"new spacing: {target_spacing}")
+        print(f"new size: {new_size}")
+        resampler = SimpleITK.ResampleImageFilter()
+        resampler.SetOutputSpacing(target_spacing)
+        resampler.SetSize(new_size)
+        resampler.SetOutputOrigin(sitk_img.GetOrigin())
+        resampler.SetOutputDirection(sitk_img.GetDirection())
+        if order == 1:
+            # Keep the interpolated values, as the GPU path does, instead of truncating them to the input pixel type
+            resampler.SetInterpolator(SimpleITK.sitkLinear)
+            resampler.SetOutputPixelType(SimpleITK.sitkFloat32)
+        else:
+            resampler.SetInterpolator(SimpleITK.sitkNearestNeighbor)
+        return resampler.Execute(sitk_img)
+
+    # Higher order splines: resize on the GPU
+    # Get npy view of the image buffer, axes are in (z, y, x) order
+    img = SimpleITK.GetArrayViewFromImage(sitk_img)
+    # Get resize factor in (z, y, x) order, sitk spacings are in (x, y, z) order
+    resize_factor = get_resize_factor(img, spacing[::-1], list(target_spacing)[::-1])
     # Calculate target shape
     new_shape = resize_factor * img.shape
     new_shape = [int(x) for x in new_shape]
 
     # Print statements
-    print(nifti_file)
     print(f"spacing: {spacing}")
     print(f"shape: {img.shape}")
     print(f"new spacing: {target_spacing}")
     print(f"new shape: {new_shape}")
 
-    # Create cupy array
-    img = cp.asarray(img)
+    # Create cupy array (asynchronous copy from pinned memory)
+    img = _to_device(img, stream)
 
-    # Resize image
-    resampled_img = resize(img, output_shape=new_shape, order=order, mode="edge", anti_aliasing=False)
+    # Resize image on the same stream, so that it is ordered after the copy
+    with stream:
+        resampled_img = _get_resize_function(img.shape, tuple(new_shape), order)(img)
 
     # Get back npy array
-    resampled_img = cp.asnumpy(resampled_img)  # Alternative: img_arr = cp.float32(resampled_img.get())
+    resampled_img = _to_host(resampled_img, stream)
 
     # --------------------------
     # Convert back to sitk image
     # --------------------------
-    # Transpose back (x, y, z) -> (z, x, y)
-    resampled_img = np.transpose(resampled_img)
     # Create sitk image
     sitk_out = SimpleITK.GetImageFromArray(resampled_img)
     # Copy sitk metadata
@@ -377,10 +638,107 @@ def resample_image(nifti_file: str, target_spacing: list, order: int) -> SimpleI
     sitk_out.SetDirection(sitk_img.GetDirection())
     sitk_out.SetSpacing(target_spacing)
 
-    # End counter
-    end_time = perf_counter()
-    # Report resampling time
-    delta_time = end_time - start_time
-    print(f"Resampling took {delta_time:.2f} seconds")
+    return sitk_out
+
+
+def resample_images(nifti_files: list, out_files: list, target_spacing: list, order: int,
+                    num_streams: int = 2) -> list:
+    """Resample a batch of images to the target spacing. Reading, resampling and writing are pipelined: two reader
+    threads decode the NIFTI files, each resampling thread owns a CUDA stream and one writer thread writes the
+    results, so that the GPU is not idle while the CPU is busy with (de)compression.
 
-    return sitk_out
\ No newline at end of file
+    :param nifti_files: NIFTI filepaths to resample
+    :type nifti_files: list
+    :param out_files: Output filepaths, one for each input file
+    :type out_files: list
+    :param target_spacing: Target spacing (can be either int or float)
+    :type target_spacing: list
+    :param order: Order of spline interpolation (0: Nearest-neighbor, 3: Bi-cubic). Use 0 for binary segmentation mask and 3 for images.
+    :type order: int
+    :param num_streams: Number of CUDA streams (and volumes resampled concurrently), 2 to 4 is sensible
+    :type num_streams: int
+    :return: Output filepaths
+    :rtype: list
+    """
+    start_time = perf_counter()
+
+    stream_pool = queue.Queue()
+    for _ in range(num_streams):
+        stream_pool.put(cp.cuda.Stream(non_blocking=True))
+    # Bounds the number of volumes held in memory between reading and writing
+    volumes_in_flight = threading.BoundedSemaphore(num_streams + 2)
+
+    def resample_task(read_future: Future) -> SimpleITK.Image:
+        stream = stream_pool.get()
+        # _to_device and _to_host wait for their copies, so no pinned staging buffer is in use once this returns
+        try:
+            return _resample_sitk_image(read_future.result(), target_spacing, order, stream)
+        finally:
+            stream_pool.put(stream)
+
+    def write_task(resample_future: Future, out_file: str) -> str:
+        try:
+            SimpleITK.WriteImage(resample_future.result(), out_file)
+            return out_file
+        finally:
+            volumes_in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=2) as reader, \
+            ThreadPoolExecutor(max_workers=num_streams) as resampler, \
+            ThreadPoolExecutor(max_workers=1) as writer:
+        write_futures = []
+        for nifti_file, out_file in zip(nifti_files, out_files):
+            volumes_in_flight.acquire()
+            read_future = reader.submit(SimpleITK.ReadImage, nifti_file)
+            resample_future = resampler.submit(resample_task, read_future)
+            write_futures.append(writer.submit(write_task, resample_future, out_file))
+        resampled_files = [write_future.result() for write_future in write_futures]
+
+    delta_time = perf_counter() - start_time
+    print(f"Resampling {len(resampled_files)} images took {delta_time:.2f} seconds")
+
+    return resampled_files
+
+
+def _init_resample_worker(device_ids: multiprocessing.Queue) -> None:
+    """
+    Pin a resampling worker process to its own GPU
+    :param device_ids: Queue with the ids of the GPUs that are not taken yet
+    """
+    cp.cuda.Device(device_ids.get()).use()
+
+
+def _resample_file(nifti_file: str, out_file: str, target_spacing: list, order: int) -> str:
+    """
+    Resample an image and write it to disk (see resample_image)
+    :return: Path to the resampled image
+    """
+    SimpleITK.WriteImage(resample_image(nifti_file, target_spacing, order), out_file)
+    return out_file
+
+
+def resample_cohort(nifti_files: list, out_files: list, target_spacing: list, order: int) -> list:
+    """Resample the images of a cohort with one worker process per GPU. The workers are spawned (not forked), as
+    CUDA cannot be used in a process forked after CUDA was initialised.
+
+    :param nifti_files: NIFTI filepaths to resample
+    :type nifti_files: list
+    :param out_files: Output filepaths, one for each input file
+    :type out_files: list
+    :param target_spacing: Target spacing (can be either int or float)
+    :type target_spacing: list
+    :param order: Order of spline interpolation (0: Nearest-neighbor, 3: Bi-cubic). Use 0 for binary segmentation mask and 3 for images.
+    :type order: int
+    :return: Output filepaths
+    :rtype: list
+    """
+    num_devices = cp.cuda.runtime.getDeviceCount()
+    context = multiprocessing.get_context('spawn')
+    device_ids = context.Queue()
+    for device_id in range(num_devices):
+        device_ids.put(device_id)
+    with ProcessPoolExecutor(max_workers=num_devices, mp_context=context, initializer=_init_resample_worker,
+                             initargs=(device_ids,)) as executor:
+        resampled_files = list(executor.map(_resample_file, nifti_files, out_files, repeat(target_spacing),
+                                            repeat(order)))
+    return resampled_files
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# **********************************************************************************************************************
+# File: imageOpGPU.py
+# Project: MOOSE Version 0.1.0
+# Description: This module contains GPU (CuPy) versions of the voxel-wise arithmetic operations in imageOP.py, so
+# that chains of operations on the same volume run as a single fused kernel instead of one pass per operation.
+# License: Apache 2.0
+# **********************************************************************************************************************
+
+import logging
+
+import cupy as cp
+import mpire
+import nibabel as nib
+import numpy as np
+from mpire import WorkerPool
+
+import constants as c
+import fileOp as fop
+
+# y = binarize(x) * m + a, i.e. binarize, scale_mask and add_image in one pass
+binarize_multiply_add_kernel = cp.ElementwiseKernel('T x, T m, T a', 'T y', 'y = ((x != 0) ? m : (T)0) + a',
+                                                    'binarize_multiply_add')
+
+
+def save_volume(volume: cp.ndarray, reference_img: nib.Nifti1Image, out_img: str) -> str:
+    """
+    Write a GPU volume to a NIFTI file, using the affine and header of a reference image
+    :param volume: GPU volume to write
+    :param reference_img: nibabel image to copy the affine and header from
+    :param out_img: Path to the output NIFTI file
+    :return: Path to the output NIFTI file
+    """
+    header = reference_img.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(cp.asnumpy(volume), reference_img.affine, header), out_img)
+    return out_img
+
+
+def _decode_volume(nifti_file: str) -> np.ndarray:
+    """
+    Decode a NIFTI file into an array. Runs in the decode workers, so it must not touch the GPU. The array keeps the
+    pixel type on disk (usually UInt8 for masks), so that no more bytes than necessary go back to the parent
+    :param nifti_file: Path to the NIFTI file
+    :return: Voxel data in its native pixel type
+    """
+    return np.asanyarray(nib.load(nifti_file).dataobj)
+
+
+def _decode_volumes(nifti_files: list):
+    """
+    Decode a list of NIFTI files in parallel and yield them in order. Decompression dominates the cost of the
+    GPU reductions below, so the files are decoded by forked workers while the parent adds them on the GPU
+    :param nifti_files: Paths to the NIFTI files
+    :return: Generator of the decoded arrays, in the order of nifti_files
+    """
+    n_jobs = min(mpire.cpu_count(), c.MAX_DECODE_WORKERS, len(nifti_files))
+    # One file per task and at most one task per worker, so no more than n_jobs decoded volumes are held at a time
+    with WorkerPool(n_jobs=n_jobs, start_method='fork') as pool:
+        yield from pool.imap(_decode_volume, nifti_files, chunk_size=1, max_tasks_active=n_jobs, progress_bar=False)
+
+
+def binarize_scale_sum(mask_files: list, scale_factors: list, out_img: str) -> str:
+    """
+    Binarize a list of masks, scale each with its own scaling factor and sum them, i.e. binarize -> scale_mask ->
+    add_image for every mask as a single GPU pass into one accumulator. The scaled masks are never written to disk.
+    :param mask_files: Paths to the masks (all of the same size)
+    :param scale_factors: Value assigned to the non-zero voxels of each mask
+    :param out_img: Path to the summed image
+    :return: Path to the summed image
+    """
+    if not mask_files:
+        logging.warning(f'No masks to sum into {out_img}')
+        return out_img
+    reference_img = nib.load(mask_files[0])
+    accumulator = cp.zeros(reference_img.shape, dtype=cp.float32)
+    for volume, scale_factor in zip(_decode_volumes(mask_files), scale_factors):
+        # Transfer in the native pixel type and convert on the device
+        volume = cp.asarray(volume).astype(cp.float32, copy=False)
+        binarize_multiply_add_kernel(volume, cp.float32(scale_factor), accumulator, accumulator)
+    return save_volume(accumulator, reference_img, out_img)
+
+
+def sum_image_stack(img_dir: str, wild_card: str, out_img: str) -> str:
+    """
+    Sum a list of images on the GPU. The images are decoded in parallel and streamed one by one into a single
+    accumulator, so only the volumes in flight are held in host memory and no intermediate files are written.
+    :param img_dir: Directory containing the list of images to sum
+    :param wild_card: Wildcard to use to find the images to sum
+    :param out_img: Path to the summed image
+    :return: Path to the summed image
+    """
+    files = fop.get_files(img_dir, wild_card)
+    if not files:
+        logging.warning(f'No images matching {wild_card} in {img_dir} to sum into {out_img}')
+        return out_img
+    nifti_img = nib.load(files[0])
+    accumulator = cp.zeros(nifti_img.shape, dtype=cp.float32)
+    for volume in _decode_volumes(files):
+        accumulator += cp.asarray(volume).astype(cp.float32, copy=False)
+    return save_volume(accumulator, nifti_img, out_img)
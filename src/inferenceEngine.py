@@ -52,9 +52,9 @@ def segment_tissue(nifti_img: str, out_dir: str, tissue_type: str) -> None:
     :return: None
     """
     model = str(model_number(tissue_type))
-    cmd_to_run = f"nnUNet_predict -i {re.escape(str(pathlib.Path(nifti_img).parents[0]))} -o {re.escape(out_dir)} -t " \
-                 f"{model} -m 3d_fullres --fold all "
-    subprocess.run(cmd_to_run, shell=True, capture_output=True)
+    cmd_to_run = ["nnUNet_predict", "-i", str(pathlib.Path(nifti_img).parents[0]), "-o", out_dir, "-t", model, "-m",
+                  "3d_fullres", "--fold", "all"]
+    subprocess.run(cmd_to_run, capture_output=True)
 
 
 def segment_ct(nifti_img: str, out_dir: str) -> str:
@@ -90,10 +90,10 @@ def segment_ct(nifti_img: str, out_dir: str) -> str:
     segment_tissue(ct_file, out_dir, 'Bones')
     spinner.succeed(text=f"Segmented Bones from {ct_file}")
     fop.add_prefix_rename(out_label, 'Bones')
-    imageOp.shift_intensity(image_to_shift=fop.get_files(out_dir, 'Bones*')[0],
-                            shift_amount=c.NUM_OF_ORGANS,
-                            out_image=fop.get_files(out_dir, 'Bones*')[0])
-    imageOp.replace_intensity(image_to_replace=fop.get_files(out_dir, 'Bones*')[0], intensity=[c.NUM_OF_ORGANS, 0],
+    shifted_img = imageOp.shift_intensity(image_to_shift=fop.get_files(out_dir, 'Bones*')[0],
+                                          shift_amount=c.NUM_OF_ORGANS,
+                                          out_image=None)
+    imageOp.replace_intensity(image_to_replace=shifted_img, intensity=[c.NUM_OF_ORGANS, 0],
                               out_image=fop.get_files(out_dir, 'Bones*')[0])
     logging.info(f"Bones segmented and saved in {fop.get_files(out_dir, 'Bones*')[0]}")
 
@@ -103,11 +103,10 @@ def segment_ct(nifti_img: str, out_dir: str) -> str:
     segment_tissue(ct_file, out_dir, 'Fat-Muscle')
     spinner.succeed(text=f"Segmented skeletal muscle, subcutaneous and visceral fat from {ct_file}")
     fop.add_prefix_rename(out_label, 'Fat-Muscle')
-    imageOp.shift_intensity(image_to_shift=fop.get_files(out_dir, 'Fat-Muscle*')[0],
-                            shift_amount=c.NUM_OF_ORGANS + c.NUM_OF_BONES,
-                            out_image=fop.get_files(out_dir, 'Fat-Muscle*')[0])
-    imageOp.replace_intensity(image_to_replace=fop.get_files(out_dir, 'Fat-Muscle*')[0], intensity=[c.NUM_OF_ORGANS +
-                                                                                                    c.NUM_OF_BONES, 0],
+    shifted_img = imageOp.shift_intensity(image_to_shift=fop.get_files(out_dir, 'Fat-Muscle*')[0],
+                                          shift_amount=c.NUM_OF_ORGANS + c.NUM_OF_BONES,
+                                          out_image=None)
+    imageOp.replace_intensity(image_to_replace=shifted_img, intensity=[c.NUM_OF_ORGANS + c.NUM_OF_BONES, 0],
                               out_image=fop.get_files(out_dir, 'Fat-Muscle*')[0])
     logging.info(f"Fat-Muscle segmented and saved in {fop.get_files(out_dir, 'Fat-Muscle*')[0]}")
 
@@ -117,12 +116,11 @@ def segment_ct(nifti_img: str, out_dir: str) -> str:
     segment_tissue(ct_file, out_dir, 'Psoas')
     spinner.succeed(text=f"Segmented psoas from {ct_file}")
     fop.add_prefix_rename(out_label, 'Psoas')
-    imageOp.shift_intensity(image_to_shift=fop.get_files(out_dir, 'Psoas*')[0],
-                            shift_amount=c.NUM_OF_ORGANS + c.NUM_OF_BONES + c.NUM_OF_FAT_MUSCLE,
-                            out_image=fop.get_files(out_dir, 'Psoas*')[0])
-    imageOp.replace_intensity(image_to_replace=fop.get_files(out_dir, 'Psoas*')[0], intensity=[c.NUM_OF_ORGANS +
-                                                                                               c.NUM_OF_BONES +
-                                                                                               c.NUM_OF_FAT_MUSCLE, 0],
+    shifted_img = imageOp.shift_intensity(image_to_shift=fop.get_files(out_dir, 'Psoas*')[0],
+                                          shift_amount=c.NUM_OF_ORGANS + c.NUM_OF_BONES + c.NUM_OF_FAT_MUSCLE,
+                                          out_image=None)
+    imageOp.replace_intensity(image_to_replace=shifted_img,
+                              intensity=[c.NUM_OF_ORGANS + c.NUM_OF_BONES + c.NUM_OF_FAT_MUSCLE, 0],
                               out_image=fop.get_files(out_dir, 'Psoas*')[0])
     logging.info(f"Psoas segmented and saved in {fop.get_files(out_dir, 'Psoas*')[0]}")
     postProcessing.ct_segmentation(label_dir=out_dir)
@@ -150,10 +148,11 @@ def segment_pt(nifti_img: str, out_dir: str) -> str:
     spinner.succeed(text=f"Segmented brain from {pt_file}")
     out_label = fop.get_files(out_dir, c.CROPPED_BRAIN_FROM_PET[:13] + '*')[0]
     fop.add_prefix_rename(out_label, 'Brain')
-    imageOp.shift_intensity(image_to_shift=fop.get_files(out_dir, 'Brain*')[0],
-                            shift_amount=c.NUM_OF_ORGANS + c.NUM_OF_BONES + c.NUM_OF_FAT_MUSCLE + c.NUM_OF_PSOAS,
-                            out_image=fop.get_files(out_dir, 'Brain*')[0])
-    imageOp.replace_intensity(image_to_replace=fop.get_files(out_dir, 'Brain*')[0], intensity=[
+    shifted_img = imageOp.shift_intensity(image_to_shift=fop.get_files(out_dir, 'Brain*')[0],
+                                          shift_amount=c.NUM_OF_ORGANS + c.NUM_OF_BONES + c.NUM_OF_FAT_MUSCLE +
+                                          c.NUM_OF_PSOAS,
+                                          out_image=None)
+    imageOp.replace_intensity(image_to_replace=shifted_img, intensity=[
         c.NUM_OF_ORGANS + c.NUM_OF_BONES + c.NUM_OF_FAT_MUSCLE + c.NUM_OF_PSOAS, 0],
                               out_image=fop.get_files(out_dir, 'Brain*')[0])
     logging.info(f"Brain segmented and saved in {fop.get_files(out_dir, 'Brain*')[0]}")